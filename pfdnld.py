@@ -1,12 +1,39 @@
 #! /usr/bin/env python3
 
-from os import environ, listdir
+from os import environ, listdir, remove, replace, stat, getpid
 from os import system as run_command
 from os.path import join as path_join
 from os.path import isabs as is_absolute_path
 from os.path import basename as path_basename
+from os.path import dirname as path_dirname
+from os.path import realpath as real_path
+from os.path import commonpath as common_path
 from shutil import move as move_file
-from syslog import syslog, LOG_INFO
+from shutil import copystat
+from hashlib import new as new_hash
+from hashlib import algorithms_guaranteed
+from fnmatch import fnmatch
+from string import hexdigits
+from shlex import quote as shell_quote
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context as get_multiprocessing_context
+import tarfile
+import zipfile
+from syslog import syslog, LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERR
+from threading import Thread, Lock, get_ident
+from queue import Queue, Empty
+from time import time as now
+from time import perf_counter
+from contextlib import contextmanager
+from collections import namedtuple
+from itertools import count
+from heapq import heappush, heappop
+from random import uniform
+import cProfile
+from atexit import register as register_at_exit
+import sys
+import re
+import signal
 from pathlib import Path
 from json import dumps as json_encode
 from json import loads as json_decode
@@ -29,14 +56,256 @@ COLORS = {
 EMPTY_COLORS = {item[0]: '' for item in COLORS.items()}
 if get_env('NO_COLORIZE') is not None:
     COLORS = EMPTY_COLORS
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+SYSLOG_PRIORITIES = {'debug': LOG_DEBUG, 'info': LOG_INFO, 'warning': LOG_WARNING, 'error': LOG_ERR}
+LOG_LEVEL = LOG_LEVELS.get((get_env('LOG_LEVEL') or 'info').lower(), LOG_LEVELS['info'])
+LOG_JSON = (get_env('LOG_FORMAT') or 'text').lower() == 'json'
+# At most LOG_RATE_LIMIT_BURST warnings/errors with the same template are written per LOG_RATE_LIMIT_PERIOD seconds.
+LOG_RATE_LIMIT_PERIOD = float(get_env('LOG_RATE_LIMIT_PERIOD') or 60)
+LOG_RATE_LIMIT_BURST = int(get_env('LOG_RATE_LIMIT_BURST') or 5)
+LOG_RATE_LIMIT_SUMMARY_TEMPLATE = '{yellow}suppressed {} repeated message(s) like {!r}{reset}'
+LOG_COLOR_PLACEHOLDERS = re.compile('|'.join(re.escape('{' + name + '}') for name in EMPTY_COLORS))
 DEFAULT_HTTP_CONNECT_TIMEOUT = 15
+CHECKSUM_ALGORITHMS = sorted(name for name in algorithms_guaranteed if not name.startswith('shake_'))
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+LINK_SCHEMES = ('http', 'https', 'ftp')
+# 4xx statuses that may succeed later or only concern the probe's method.
+TRANSIENT_HTTP_STATUSES = (405, 408, 425, 429)
+# The link being tried is ([link] + mirrors)[mirror_index], retry_round counts rounds over all of them.
+DownloadJob = namedtuple(
+    'DownloadJob',
+    ['link', 'output_dir', 'checksum', 'mirrors', 'attempt', 'mirror_index', 'retry_round'],
+    defaults=(0, 0, 0)
+)
 
+log_queue = None
+log_lock = Lock()
+log_synchronous = False
+log_rate_limits = {}
+log_rate_limit_lock = Lock()
 
-def log(text, parameters=None):
+
+def set_log_synchronous():
+    # Worker processes may exit without running atexit handlers, so they write logs directly.
+    global log_synchronous
+    log_synchronous = True
+
+
+def init_post_process_worker():
+    # Ctrl-C stops the main process, which then waits for queued post-processing jobs to finish.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_log_synchronous()
+
+
+def write_log_record(record):
+    timestamp, level, text, parameters = record
+    if level is None:
+        LOG_JSON or sys.stdout.write(text + '\n')
+        return
+    if LOG_JSON:
+        sys.stdout.write(
+            json_encode(
+                {'time': timestamp, 'level': level, 'message': text.format(*parameters, **EMPTY_COLORS)}
+            ) + '\n'
+        )
+    else:
+        sys.stdout.write(text.format(*parameters, **COLORS) + '\n')
+    SYSLOG and syslog(SYSLOG_PRIORITIES[level], text.format(*parameters, **EMPTY_COLORS))
+
+
+def drain_log_queue(queue):
+    while True:
+        try:
+            records = [queue.get(timeout=1)]
+        except Empty:
+            records = []
+        while not queue.empty():
+            records.append(queue.get())
+        # Summaries of rate-limited templates whose window expired without another message.
+        summaries = pop_log_rate_limit_summaries(now())
+        for record in records + summaries:
+            try:
+                write_log_record(record)
+            except Exception as write_error:
+                sys.stderr.write('could not write log {!r}: {}\n'.format(record[2], write_error))
+        (records or summaries) and sys.stdout.flush()
+        for _ in records:
+            queue.task_done()
+
+
+def enqueue_log_record(record):
+    global log_queue
+    if log_synchronous:
+        write_log_record(record)
+        sys.stdout.flush()
+        return
+    if log_queue is None:
+        with log_lock:
+            if log_queue is None:
+                queue = Queue()
+                Thread(target=drain_log_queue, args=(queue,), name='pfdnld-log', daemon=True).start()
+                log_queue = queue
+    log_queue.put(record)
+
+
+def strip_log_colors(text):
+    return LOG_COLOR_PLACEHOLDERS.sub('', text)
+
+
+def pop_log_rate_limit_summaries(timestamp, expired_only=True):
+    summaries = []
+    with log_rate_limit_lock:
+        for text, (window_start, _, suppressed) in list(log_rate_limits.items()):
+            if expired_only and timestamp - window_start < LOG_RATE_LIMIT_PERIOD:
+                continue
+            if suppressed:
+                summaries.append(
+                    (timestamp, 'warning', LOG_RATE_LIMIT_SUMMARY_TEMPLATE, [suppressed, strip_log_colors(text)])
+                )
+            del log_rate_limits[text]
+    return summaries
+
+
+def is_log_rate_limited(text, timestamp):
+    with log_rate_limit_lock:
+        window_start, count, suppressed = log_rate_limits.get(text, (timestamp, 0, 0))
+        if timestamp - window_start >= LOG_RATE_LIMIT_PERIOD:
+            if suppressed:
+                enqueue_log_record(
+                    (timestamp, 'warning', LOG_RATE_LIMIT_SUMMARY_TEMPLATE, [suppressed, strip_log_colors(text)])
+                )
+            window_start, count, suppressed = timestamp, 0, 0
+        count += 1
+        if count > LOG_RATE_LIMIT_BURST:
+            suppressed += 1
+        log_rate_limits[text] = (window_start, count, suppressed)
+        return count > LOG_RATE_LIMIT_BURST
+
+
+def log(text, parameters=None, level='info'):
+    if LOG_LEVELS[level] < LOG_LEVEL:
+        return
+    timestamp = now()
+    if LOG_LEVELS[level] >= LOG_LEVELS['warning'] and is_log_rate_limited(text, timestamp):
+        return
     if parameters is None:
         parameters = []
-    print(text.format(*parameters, **COLORS))
-    SYSLOG and syslog(LOG_INFO, text.format(*parameters, **EMPTY_COLORS))
+    enqueue_log_record((timestamp, level, text, parameters))
+
+
+def log_separator(text='-' * 80):
+    enqueue_log_record((now(), None, text, None))
+
+
+def flush_log():
+    log_queue is not None and not log_synchronous and log_queue.join()
+
+
+def close_log():
+    for summary in pop_log_rate_limit_summaries(now(), expired_only=False):
+        enqueue_log_record(summary)
+    flush_log()
+
+
+register_at_exit(close_log)
+
+
+trace_fd = None
+trace_event_separator = ''
+trace_lock = Lock()
+trace_job_ids = count(1)
+profiler = None
+
+
+def enable_tracing(filename):
+    # Events are appended to a JSON array, Chrome trace viewers accept it even if it is not closed yet. Every event
+    # is flushed once written, so a killed process leaves a readable trace behind.
+    global trace_fd
+    try:
+        trace_fd = open(filename, 'w')
+        trace_fd.write('[')
+    except Exception as open_error:
+        log('{red}could not open trace file {yellow}{!r}{reset}{red}: {}', [filename, open_error], 'error')
+        trace_fd = None
+        return False
+    return True
+
+
+def begin_trace_span(name, **arguments):
+    if trace_fd is None:
+        return None
+    return name, arguments, perf_counter()
+
+
+def end_trace_span(span):
+    global trace_event_separator
+    if span is None or trace_fd is None:
+        return
+    name, arguments, start = span
+    end = perf_counter()
+    # Chrome trace-event "complete" event, timestamps are in microseconds.
+    event = json_encode(
+        {
+            'name': name,
+            'cat': 'pfdnld',
+            'ph': 'X',
+            'ts': start * 1000000,
+            'dur': (end - start) * 1000000,
+            'pid': getpid(),
+            'tid': get_ident(),
+            'args': arguments
+        },
+        default=str
+    )
+    with trace_lock:
+        try:
+            trace_fd.write(trace_event_separator + event)
+            trace_fd.flush()
+        except Exception as write_error:
+            log('{red}could not write trace event: {}{reset}', [write_error], 'error')
+        trace_event_separator = ',\n'
+
+
+@contextmanager
+def trace_span(name, **arguments):
+    span = begin_trace_span(name, **arguments)
+    try:
+        yield
+    finally:
+        end_trace_span(span)
+
+
+def close_trace():
+    global trace_fd
+    if trace_fd is None:
+        return
+    with trace_lock:
+        try:
+            trace_fd.write('\n]\n')
+            trace_fd.close()
+        except Exception as write_error:
+            log('{red}could not close trace file: {}{reset}', [write_error], 'error')
+        trace_fd = None
+
+
+def toggle_profiler(filename):
+    # Called from a signal handler, so it writes to stderr instead of using log() and its locks.
+    global profiler
+    if profiler is None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        sys.stderr.write('started profiling\n')
+        return
+    profiler.disable()
+    try:
+        profiler.dump_stats(filename)
+    except Exception as write_error:
+        sys.stderr.write('could not write profile to file {!r}: {}\n'.format(filename, write_error))
+    else:
+        sys.stderr.write('stopped profiling, wrote profile to {!r}\n'.format(filename))
+    profiler = None
 
 
 def is_file_modified(filename, last_modify_time):
@@ -62,7 +331,7 @@ def link_number_template(link):
     def log_and_return():
         log(
             '{red}bad number template {reset}{white}{!r}{reset}{red} in link {!r}{reset}',
-            [extracted_text, link]
+            [extracted_text, link], 'error'
         )
         return [link]
 
@@ -82,38 +351,87 @@ def link_number_template(link):
     return links
 
 
+def parse_checksum(text):
+    algorithm, separator, digest = text.partition('=')
+    algorithm = algorithm.lower()
+    if not separator or algorithm not in CHECKSUM_ALGORITHMS:
+        return None
+    digest = digest.lower()
+    if len(digest) != new_hash(algorithm).digest_size * 2 or not all(char in hexdigits for char in digest):
+        return None
+    return algorithm, digest
+
+
+def is_link(text):
+    parsed_text = url_parser.urlparse(text)
+    return parsed_text.scheme in LINK_SCHEMES and bool(parsed_text.netloc)
+
+
+def parse_link_message(message, prefix_path):
+    parts = message.split(' ')
+    link, path, checksum, mirrors = parts[0], None, None, []
+    for part in parts[1:]:
+        part_checksum = parse_checksum(part)
+        if part_checksum is not None and checksum is None:
+            checksum = part_checksum
+        elif is_link(part):
+            mirrors.append(part)
+        elif path is None:
+            path = part
+        else:
+            return None
+    if path is None:
+        path = prefix_path
+    else:
+        while path and path[0] == '/':
+            path = path[1:]
+        path = path_join(prefix_path, path)
+    templated_links = link_number_template(link)
+    if checksum is not None and len(templated_links) > 1:
+        log(
+            '{yellow}ignoring checksum of templated link {!r} since it expands to {} links{reset}',
+            [link, len(templated_links)], 'warning'
+        )
+        checksum = None
+    templated_mirrors = []
+    for mirror in mirrors:
+        mirror_links = link_number_template(mirror)
+        if len(mirror_links) != len(templated_links):
+            log(
+                '{yellow}ignoring mirror {!r} of link {!r} since it expands to {} link(s) instead of {}{reset}',
+                [mirror, link, len(mirror_links), len(templated_links)], 'warning'
+            )
+            continue
+        templated_mirrors.append(mirror_links)
+    return [
+        DownloadJob(templated_link, path, checksum, [mirror_links[index] for mirror_links in templated_mirrors])
+        for index, templated_link in enumerate(templated_links)
+    ]
+
+
 def read_links_from_file(filename, prefix_path):
     links = []
     if not Path(filename).exists():
-        log('{yellow}could not found link file {!r}{reset}', [filename])
+        log('{yellow}could not found link file {!r}{reset}', [filename], 'warning')
         return links
     try:
         fd = open(filename)
     except Exception as open_error:
-        log('{red}could not open link file {!r} for reading: {}', [filename, open_error])
+        log('{red}could not open link file {!r} for reading: {}', [filename, open_error], 'error')
         return links
     for line_number, line in enumerate(fd.read().splitlines(), 1):
         line = line.strip()
         if not line or line.startswith('#'):
             continue
-        parts = line.split(' ')
-        part_count = len(parts)
-        if part_count == 1:
-            link, path = line, prefix_path
-        elif part_count == 2:
-            link, path = parts
-            while path and path[0] == '/':
-                path = path[1:]
-            path = path_join(prefix_path, path)
-        else:
-            log('{red}detected line {} with unknown parts: {!r}{reset}', [line_number, line])
+        line_links = parse_link_message(line, prefix_path)
+        if line_links is None:
+            log('{red}detected line {} with unknown parts: {!r}{reset}', [line_number, line], 'error')
             continue
-        for templated_link in link_number_template(link):
-            links.append((templated_link, path))
-    for link, output_dir in links:
+        links.extend(line_links)
+    for job in links:
         log(
             'detected link {yellow}{!r}{reset} with output directory {white}{!r}{reset}',
-            [link, output_dir]
+            [job.link, job.output_dir]
         )
     return links
 
@@ -122,7 +440,7 @@ def truncate_file(filename):
     try:
         fd = open(filename, 'w')
     except Exception as open_error:
-        log('{red}could not open file {!r} for truncating: {}', [filename, open_error])
+        log('{red}could not open file {!r} for truncating: {}', [filename, open_error], 'error')
         return False
     fd.close()
     return True
@@ -138,12 +456,15 @@ def truncate_download_result_file(filename):
     try:
         fd = open(filename, 'w')
     except Exception as open_error:
-        log('{red}could not open file {yellow}{!r}{reset}{red} for writing: {}', [filename, open_error])
+        log('{red}could not open file {yellow}{!r}{reset}{red} for writing: {}', [filename, open_error], 'error')
         return False
     try:
         fd.write('{}\n'.format(json_encode([])))
     except Exception as write_error:
-        log('{red}could not write empty download result to file {yellow}{!r}{reset}{red}: {}', [filename, write_error])
+        log(
+            '{red}could not write empty download result to file {yellow}{!r}{reset}{red}: {}',
+            [filename, write_error], 'error'
+        )
         return False
     fd.close()
     return True
@@ -153,14 +474,14 @@ def append_download_attempt_to_file(filename, link, output_dir):
     try:
         fd = open(filename, 'a')
     except Exception as open_error:
-        log('{red}could not open file {!r} for appending attempt status: {}', [filename, open_error])
+        log('{red}could not open file {!r} for appending attempt status: {}', [filename, open_error], 'error')
         return False
     text = '{} {} '.format(link, output_dir)
     length = len(text) + 5  # (len(str(False)))
     try:
         fd.write((length * '*') + '\n' + text)
     except Exception as write_error:
-        log('{red}could not write attempt status to file {!r}: {}', [filename, write_error])
+        log('{red}could not write attempt status to file {!r}: {}', [filename, write_error], 'error')
         return False
     fd.close()
     return True
@@ -170,12 +491,12 @@ def append_download_result_to_file(filename, link, output_directory, download_re
     try:
         fd = open(filename)
     except Exception as open_error:
-        log('{red}could not open file {yellow}{!r}{reset}{red} for reading: {}', [filename, open_error])
+        log('{red}could not open file {yellow}{!r}{reset}{red} for reading: {}', [filename, open_error], 'error')
         return False
     try:
         data = fd.read()
     except Exception as open_error:
-        log('{red}could not read file {yellow}{!r}{reset}{red}: {}', [filename, open_error])
+        log('{red}could not read file {yellow}{!r}{reset}{red}: {}', [filename, open_error], 'error')
         return False
     fd.close()
     try:
@@ -184,7 +505,7 @@ def append_download_result_to_file(filename, link, output_directory, download_re
         if data_type != list:
             raise ValueError("Excepted list, got {!r}".format(data_type))
     except Exception as decode_error:
-        log('{red}could not decode file {yellow}{!r}{reset}{red} data: {}', [filename, decode_error])
+        log('{red}could not decode file {yellow}{!r}{reset}{red} data: {}', [filename, decode_error], 'error')
         return False
     if download_result is None:
         data.append({'link': link, 'output_directory': output_directory, 'status': 'waiting'})
@@ -198,12 +519,15 @@ def append_download_result_to_file(filename, link, output_directory, download_re
     try:
         fd = open(filename, 'w')
     except Exception as open_error:
-        log('{red}could not open file {yellow}{!r}{reset}{red} for writing: {}', [filename, open_error])
+        log('{red}could not open file {yellow}{!r}{reset}{red} for writing: {}', [filename, open_error], 'error')
         return False
     try:
         fd.write('{}\n'.format(json_encode(data, indent=4)))
     except Exception as write_error:
-        log('{red}could not write download result to file {yellow}{!r}{reset}{red}: {}', [filename, write_error])
+        log(
+            '{red}could not write download result to file {yellow}{!r}{reset}{red}: {}',
+            [filename, write_error], 'error'
+        )
         return False
     fd.close()
     return True
@@ -220,10 +544,17 @@ def download_links_via_command(
     tls,
     markdown,
     port,
-    http_connection_timeout
+    http_connection_timeout,
+    checksum_sidecar=None,
+    checksum_retries=1,
+    post_process=None,
+    schedule_retry=None
 ):
     result = []
-    for link, output_dir in links:
+    for job in links:
+        link = ([job.link] + job.mirrors)[job.mirror_index]
+        output_dir = job.output_dir
+        checksum = job.checksum
         extras = None
         before_download_text = 'Downloading {} to {}'
         after_download_text = ' {} to {}'
@@ -232,57 +563,218 @@ def download_links_via_command(
             before_download_text = 'Downloading \n**{}** \nto \n**{}**'
             after_download_text = ' \n**{}** \nto \n**{}**'
         filename = path_basename(url_parser.urlparse(link).path)
-        send_notification_result = send_notification(
-            host,
-            before_download_text.format(filename, output_dir),
-            application_token,
-            priority,
-            title,
-            tls,
-            extras,
-            port,
-            http_connection_timeout
-        )
-        download_result = download_link_via_command(command, link)
-        move_downloaded_files_to_output_directory(output_dir)
-        if send_notification_result is not False:
-            delete_notification(
+        trace = {'job': next(trace_job_ids), 'link': link, 'attempt': job.attempt}
+        job_span = begin_trace_span('job', **trace)
+        with trace_span('send_notification', **trace):
+            send_notification_result = send_notification(
                 host,
-                send_notification_result,
-                client_token,
+                before_download_text.format(filename, output_dir),
+                application_token,
+                priority,
+                title,
                 tls,
+                extras,
                 port,
                 http_connection_timeout
             )
+        if checksum is None and checksum_sidecar is not None:
+            with trace_span('fetch_checksum_sidecar', **trace):
+                checksum = fetch_checksum_sidecar(link, checksum_sidecar, http_connection_timeout)
+        checksum_attempt = 0
+        moved_files = []
+        while True:
+            with trace_span('download_command', checksum_attempt=checksum_attempt, **trace):
+                command_result = download_link_via_command(command, link)
+            with trace_span('move_file', checksum_attempt=checksum_attempt, **trace):
+                attempt_moved_files, checksum_result = move_downloaded_files_to_output_directory(
+                    output_dir,
+                    filename,
+                    checksum
+                )
+            moved_files.extend(attempt_moved_files)
+            if not command_result or checksum_result is not False or checksum_attempt >= checksum_retries:
+                break
+            checksum_attempt += 1
+            log(
+                '{yellow}re-downloading link {!r} after checksum mismatch ({}/{}){reset}',
+                [link, checksum_attempt, checksum_retries], 'warning'
+            )
+        download_result = command_result and checksum_result is not False
+        retry_delay = None
+        if not download_result and schedule_retry is not None:
+            with trace_span('schedule_retry', **trace):
+                permanent = not command_result and is_permanent_download_error(link, http_connection_timeout)
+                retry_delay = schedule_retry(job, permanent)
+        if download_result and post_process is not None:
+            with trace_span('post_process', **trace):
+                post_process(moved_files)
+        if send_notification_result is not False:
+            with trace_span('delete_notification', **trace):
+                delete_notification(
+                    host,
+                    send_notification_result,
+                    client_token,
+                    tls,
+                    port,
+                    http_connection_timeout
+                )
         message_prefix = 'Downloaded' if download_result else 'Error downloading'
-        send_notification(
-            host,
-            message_prefix + after_download_text.format(filename, output_dir),
-            application_token,
-            priority,
-            title,
-            tls,
-            extras,
-            port,
-            http_connection_timeout
-        )
+        if retry_delay is not None:
+            message_prefix = 'Retrying in {}s'.format(round(retry_delay))
+        with trace_span('send_notification', **trace):
+            send_notification(
+                host,
+                message_prefix + after_download_text.format(filename, output_dir),
+                application_token,
+                priority,
+                title,
+                tls,
+                extras,
+                port,
+                http_connection_timeout
+            )
+        end_trace_span(job_span)
         result.append((link, output_dir, download_result))
     return result
 
 
 def download_link_via_command(command, link):
     command = command.format(**{'link': link})
-    print('-' * 80)
+    log_separator()
     log('attempt to run command {white}{!r}{reset}', [command])
+    flush_log()
     status = run_command(command)
-    print()
+    log_separator('')
     status is 0 and log('link {white}{!r}{reset} downloaded', [link])
-    status is not 0 and log('{red}could not download the link {!r}{reset}', [link])
-    print('-' * 80)
+    status is not 0 and log('{red}could not download the link {!r}{reset}', [link], 'error')
+    log_separator()
     return status is 0
 
 
-def move_downloaded_files_to_output_directory(output_dir):
+def is_permanent_download_error(link, timeout=None):
+    # Probes link with a ranged GET (HEAD is rejected by some origins and presigned URLs are signed per method),
+    # client errors (4xx) won't go away by retrying.
+    parsed_link = url_parser.urlparse(link)
+    if parsed_link.scheme not in ('http', 'https'):
+        return False
+    try:
+        port = parsed_link.port
+    except ValueError as port_error:
+        log('{yellow}could not probe link {!r}: {}{reset}', [link, port_error], 'warning')
+        return False
+    http_connection = make_http_connection(parsed_link.hostname, port, parsed_link.scheme == 'https', timeout)
+    if http_connection is False:
+        return False
+    http_path = parsed_link.path or '/'
+    if parsed_link.query:
+        http_path += '?' + parsed_link.query
+    try:
+        http_connection.request('GET', http_path, headers={'Range': 'bytes=0-0'})
+        status = http_connection.getresponse().status
+    except Exception as request_error:
+        log('{yellow}could not probe link {!r}: {}{reset}', [link, request_error], 'warning')
+        return False
+    finally:
+        http_connection.close()
+    permanent = 400 <= status < 500 and status not in TRANSIENT_HTTP_STATUSES
+    log('link {white}{!r}{reset} responded with HTTP status {white}{}{reset}', [link, status])
+    return permanent
+
+
+def make_retry_scheduler(retry_queue, max_attempts=5, delay=30, max_delay=3600):
+    # Failed jobs are pushed to retry_queue (a heap of (due time, sequence, job)). In each round the link and its
+    # mirrors are tried in order without delay, then the next round starts after an exponential backoff with jitter.
+    sequence = count()
+
+    def schedule_retry(job, permanent=False):
+        candidates = [job.link] + job.mirrors
+        mirror_index = job.mirror_index
+        retry_round = job.retry_round
+        link = candidates[mirror_index]
+        attempt = job.attempt + 1
+        if permanent:
+            log('{red}link {!r} failed permanently, not retrying it{reset}', [link], 'error')
+            del candidates[mirror_index]
+        else:
+            mirror_index += 1
+        if not candidates or attempt >= max_attempts:
+            log(
+                '{red}giving up on link {!r} for {!r} after {} attempt(s){reset}',
+                [link, job.output_dir, attempt], 'error'
+            )
+            return None
+        if mirror_index < len(candidates):
+            retry_delay = 0
+        else:
+            mirror_index = 0
+            retry_round += 1
+            retry_delay = min(max_delay, delay * 2 ** (retry_round - 1))
+            retry_delay = uniform(retry_delay / 2, retry_delay)
+        heappush(
+            retry_queue,
+            (
+                now() + retry_delay,
+                next(sequence),
+                job._replace(
+                    link=candidates[0],
+                    mirrors=candidates[1:],
+                    attempt=attempt,
+                    mirror_index=mirror_index,
+                    retry_round=retry_round
+                )
+            )
+        )
+        log(
+            '{yellow}scheduled link {!r} for attempt {}/{} in {:.0f} second(s){reset}',
+            [candidates[mirror_index], attempt + 1, max_attempts, retry_delay], 'warning'
+        )
+        return retry_delay
+
+    return schedule_retry
+
+
+def pop_due_retries(retry_queue):
+    jobs = []
+    timestamp = now()
+    while retry_queue and retry_queue[0][0] <= timestamp:
+        jobs.append(heappop(retry_queue)[2])
+    return jobs
+
+
+def move_file_with_checksum(source, destination, checksum):
+    # Hashes while moving so each byte is read once; destination is only replaced if the digest matches.
+    algorithm, expected_digest = checksum
+    hasher = new_hash(algorithm)
+    if stat(source).st_dev == stat(path_dirname(destination) or '.').st_dev:
+        with open(source, 'rb') as source_fd:
+            for chunk in iter(lambda: source_fd.read(CHECKSUM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        if hasher.hexdigest() != expected_digest:
+            remove(source)
+            return False
+        replace(source, destination)
+        return True
+    temporary_destination = destination + '.pfdnld'
+    try:
+        with open(source, 'rb') as source_fd, open(temporary_destination, 'wb') as destination_fd:
+            for chunk in iter(lambda: source_fd.read(CHECKSUM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+                destination_fd.write(chunk)
+        copystat(source, temporary_destination)
+    except Exception:
+        Path(temporary_destination).exists() and remove(temporary_destination)
+        raise
+    remove(source)
+    if hasher.hexdigest() != expected_digest:
+        remove(temporary_destination)
+        return False
+    replace(temporary_destination, destination)
+    return True
+
+
+def move_downloaded_files_to_output_directory(output_dir, filename=None, checksum=None):
+    # Returns moved files and the checksum verification result of filename (or the only file found), None if not
+    # verified.
     files = listdir()
     files is not [] and log('found {white}{}{reset} file(s) in temporary download folder', [len(files)])
     try:
@@ -290,22 +782,202 @@ def move_downloaded_files_to_output_directory(output_dir):
     except FileExistsError:
         pass
     except Exception as make_dir_error:
-        log('{red}could not create output directory {!r}: {}{reset}', [output_dir, make_dir_error])
-        return
-    for item in files:
-        if Path(item).is_file():
-            out_address = path_join(output_dir, item)
-            Path(out_address).exists() and log(
-                'file {white}{}{reset} already exists, we try to replace it', [out_address]
-            )
-            log(
-                'attempt to move file {white}{}{reset} to output directory {white}{}{reset}',
-                [item, output_dir]
-            )
-            try:
+        log('{red}could not create output directory {!r}: {}{reset}', [output_dir, make_dir_error], 'error')
+        return [], None
+    regular_files = [item for item in files if Path(item).is_file()]
+    checksum_file = None
+    checksum_result = None
+    if checksum is not None:
+        if filename in regular_files:
+            checksum_file = filename
+        elif len(regular_files) == 1:
+            checksum_file = regular_files[0]
+        else:
+            # The other files are still moved so they don't leak into the next download.
+            log('{red}could not find downloaded file {!r} to verify its checksum{reset}', [filename], 'error')
+            checksum_result = False
+    moved_files = []
+    for item in regular_files:
+        out_address = path_join(output_dir, item)
+        Path(out_address).exists() and log(
+            'file {white}{}{reset} already exists, we try to replace it', [out_address]
+        )
+        log(
+            'attempt to move file {white}{}{reset} to output directory {white}{}{reset}',
+            [item, output_dir]
+        )
+        try:
+            if item == checksum_file:
+                checksum_result = move_file_with_checksum(item, out_address, checksum)
+                checksum_result and log(
+                    'file {white}{}{reset} matches {white}{}{reset} checksum', [out_address, checksum[0]]
+                )
+                checksum_result or log(
+                    '{red}file {!r} does not match {} checksum {!r}, removed it{reset}',
+                    [item, checksum[0], checksum[1]], 'error'
+                )
+            else:
                 move_file(item, out_address)
-            except Exception as move_error:
-                print('{red}could not move the file {!r} to {!r}: {}{reset}', [item, output_dir, move_error])
+        except Exception as move_error:
+            log('{red}could not move the file {!r} to {!r}: {}{reset}', [item, output_dir, move_error], 'error')
+            if item == checksum_file:
+                checksum_result = False
+            continue
+        if item != checksum_file or checksum_result:
+            moved_files.append(out_address)
+    return moved_files, checksum_result
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+
+def check_tar_members(archive, output_dir):
+    # Used where tarfile has no extraction filters: members must stay inside output_dir.
+    output_dir = real_path(output_dir)
+
+    def is_inside_output_dir(name):
+        return common_path([output_dir, real_path(path_join(output_dir, name))]) == output_dir
+
+    for member in archive.getmembers():
+        if is_absolute_path(member.name) or not is_inside_output_dir(member.name):
+            raise ValueError('member {!r} is outside of the output directory'.format(member.name))
+        if member.issym() and (
+            is_absolute_path(member.linkname) or
+            not is_inside_output_dir(path_join(path_dirname(member.name), member.linkname))
+        ):
+            raise ValueError('symbolic link {!r} points outside of the output directory'.format(member.name))
+        if member.islnk() and (is_absolute_path(member.linkname) or not is_inside_output_dir(member.linkname)):
+            raise ValueError('hard link {!r} points outside of the output directory'.format(member.name))
+        if member.isdev():
+            raise ValueError('member {!r} is a device file'.format(member.name))
+
+
+def extract_archive(filename, delete_after_extract=False):
+    # Runs in a post-processing worker process.
+    output_dir = path_dirname(filename)
+    log('attempt to extract archive {white}{}{reset} to {white}{}{reset}', [filename, output_dir])
+    try:
+        if filename.lower().endswith(ZIP_EXTENSIONS):
+            with zipfile.ZipFile(filename) as archive:
+                archive.extractall(output_dir)
+        else:
+            with tarfile.open(filename) as archive:
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extractall(output_dir, filter='data')
+                else:
+                    check_tar_members(archive, output_dir)
+                    archive.extractall(output_dir)
+    except Exception as extract_error:
+        log('{red}could not extract archive {!r}: {}{reset}', [filename, extract_error], 'error')
+        return False
+    log('archive {white}{}{reset} extracted', [filename])
+    if delete_after_extract:
+        try:
+            remove(filename)
+        except Exception as remove_error:
+            log('{red}could not delete extracted archive {!r}: {}{reset}', [filename, remove_error], 'error')
+            return False
+        log('deleted extracted archive {white}{}{reset}', [filename])
+    return True
+
+
+def run_post_download_command(command, filename):
+    # Runs in a post-processing worker process.
+    # File names come from remote servers, so they are quoted for the shell.
+    command = command.format(**{'file': shell_quote(filename), 'directory': shell_quote(path_dirname(filename))})
+    log('attempt to run post-download command {white}{!r}{reset}', [command])
+    flush_log()
+    status = run_command(command)
+    status == 0 or log('{red}post-download command {!r} exited with status {}{reset}', [command, status], 'error')
+    return status == 0
+
+
+def make_post_processor(
+    pool,
+    extract=False,
+    delete_after_extract=False,
+    command=None,
+    command_pattern='*'
+):
+    def log_result(action, filename):
+        def callback(future):
+            if future.cancelled():
+                log('{red}cancelled queued job to {} {!r}{reset}', [action, filename], 'error')
+                return
+            try:
+                future.result()
+            except Exception as post_process_error:
+                log('{red}could not {} {!r}: {}{reset}', [action, filename, post_process_error], 'error')
+        return callback
+
+    def post_process(filenames):
+        for filename in filenames:
+            if extract and is_archive(filename):
+                log('queued archive {white}{}{reset} for extraction', [filename])
+                future = pool.submit(extract_archive, filename, delete_after_extract)
+                future.add_done_callback(log_result('extract', filename))
+            # Archives handled by extract are not passed to command.
+            elif command is not None and fnmatch(path_basename(filename), command_pattern):
+                log('queued file {white}{}{reset} for post-download command', [filename])
+                future = pool.submit(run_post_download_command, command, filename)
+                future.add_done_callback(log_result('run post-download command for', filename))
+
+    return post_process
+
+
+def fetch_checksum_sidecar(link, algorithm, timeout=None):
+    parsed_link = url_parser.urlparse(link)
+    if parsed_link.scheme not in ('http', 'https'):
+        log('{yellow}could not fetch {} checksum file of non-HTTP link {!r}{reset}', [algorithm, link], 'warning')
+        return None
+    try:
+        port = parsed_link.port
+    except ValueError as port_error:
+        log(
+            '{yellow}could not fetch {} checksum file of link {!r}: {}{reset}',
+            [algorithm, link, port_error], 'warning'
+        )
+        return None
+    http_connection = make_http_connection(parsed_link.hostname, port, parsed_link.scheme == 'https', timeout)
+    if http_connection is False:
+        return None
+    http_path = parsed_link.path + '.' + algorithm
+    if parsed_link.query:
+        http_path += '?' + parsed_link.query
+    try:
+        http_connection.request('GET', http_path)
+        http_response = http_connection.getresponse()
+        response = http_response.read()
+    except Exception as request_error:
+        log(
+            '{red}could not fetch {} checksum file {reset}{yellow}{}{reset}{red}:{reset} {white}{}{reset}',
+            [algorithm, http_path, request_error], 'error'
+        )
+        return None
+    if http_response.status != 200:
+        log(
+            '{yellow}could not fetch {} checksum file {!r}: HTTP status {}{reset}',
+            [algorithm, http_path, http_response.status], 'warning'
+        )
+        return None
+    filename = path_basename(parsed_link.path)
+    lines = response.decode(errors='replace').splitlines()
+    # Lines are in `sha256sum` format: `<DIGEST> <FILENAME>` or just `<DIGEST>`.
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) == 1 or parts[-1].lstrip('*') == filename or len(lines) == 1:
+            checksum = parse_checksum(algorithm + '=' + parts[0])
+            if checksum is not None:
+                log('fetched {white}{}{reset} checksum for link {yellow}{!r}{reset}', [algorithm, link])
+                return checksum
+    log(
+        '{yellow}could not find {} checksum of {!r} in checksum file {!r}{reset}',
+        [algorithm, filename, http_path], 'warning'
+    )
+    return None
 
 
 def make_http_connection(host, port, tls, timeout):
@@ -320,7 +992,7 @@ def make_http_connection(host, port, tls, timeout):
     except Exception as connect_error:
         log(
             '{red}could not connect to {reset}{yellow}{}:{}{reset}{red}:{reset} {white}{}{reset}',
-            [host, port, connect_error]
+            [host, port, connect_error], 'error'
         )
         return False
     return http_connection
@@ -333,7 +1005,7 @@ def read_and_decode_http_response(http_connection, host, port, http_path, body,
         log(
             '{red}could not get response from {reset}{yellow}{}:{}/{}{reset}{red} with body{reset} {yellow}{}{reset}{re'
             'd}:{reset} {white}{}{reset}',
-            [host, port, http_path, body, request_error]
+            [host, port, http_path, body, request_error], 'error'
         )
         return False
     try:
@@ -342,7 +1014,7 @@ def read_and_decode_http_response(http_connection, host, port, http_path, body,
         log(
             '{red}could not read response from {reset}{yellow}{}:{}/{}{reset}{red} with body{reset} {yellow}{}{reset}{r'
             'ed}:{reset} {white}{}{reset}',
-            [host, port, http_path, body, response_error]
+            [host, port, http_path, body, response_error], 'error'
         )
         return False
     if not response:
@@ -353,7 +1025,7 @@ def read_and_decode_http_response(http_connection, host, port, http_path, body,
         log(
             '{red}could not decode response {reset}{yellow}{!r}{reset}{red} from {reset}{yellow}{}:{}/{}{reset}{red} wi'
             'th body{reset} {yellow}{}{reset}{red}:{reset} {white}{}{reset}',
-            [response, host, port, http_path, body, decode_error]
+            [response, host, port, http_path, body, decode_error], 'error'
         )
         return False
     if 'errorDescription' in response.keys():
@@ -361,7 +1033,7 @@ def read_and_decode_http_response(http_connection, host, port, http_path, body,
         log(
             '{red}could {} {reset}{yellow}{}:{}/{}{reset}{red} with body{reset} {yellow}{}{reset}{red'
             '}:{reset} {white}{}{reset}',
-            [log_text, host, port, http_path, body, reason]
+            [log_text, host, port, http_path, body, reason], 'error'
         )
         return False
     return response
@@ -398,7 +1070,7 @@ def send_notification(
         log(
             '{red}could not send request to {reset}{yellow}{}:{}/{}{reset}{red} with body{reset} {yellow}{}{reset}{red}'
             ':{reset} {white}{}{reset}',
-            [host, port, log_http_path, body_json, request_error]
+            [host, port, log_http_path, body_json, request_error], 'error'
         )
         return False
     response = read_and_decode_http_response(
@@ -436,7 +1108,7 @@ def delete_notification(
     except Exception as request_error:
         log(
             '{red}could not send request to {reset}{yellow}{}:{}{}{reset}{red}:{reset} {white}{}{reset}',
-            [host, port, http_path, request_error]
+            [host, port, http_path, request_error], 'error'
         )
         return False
     response = read_and_decode_http_response(http_connection, host, port, http_path, '', 'delete notification from')
@@ -464,27 +1136,28 @@ def fetch_link_list(
     notification_list = []
     since_message_id = 0
     while True:
-        http_connection = make_http_connection(host, port, tls, timeout)
-        if http_connection is False:
-            break
-        http_path = '/application/{}/message?'.format(application_id) + \
-                    url_parser.urlencode({'since': since_message_id, 'limit': limit})
-        try:
-            http_connection.request('GET', http_path, '', http_headers)
-        except Exception as request_error:
-            log(
-                '{red}could not send request to {reset}{yellow}{}:{}/{}:{reset} {white}{}{reset}',
-                [host, port, http_path, request_error]
+        with trace_span('fetch_link_list page', since=since_message_id, limit=limit):
+            http_connection = make_http_connection(host, port, tls, timeout)
+            if http_connection is False:
+                break
+            http_path = '/application/{}/message?'.format(application_id) + \
+                        url_parser.urlencode({'since': since_message_id, 'limit': limit})
+            try:
+                http_connection.request('GET', http_path, '', http_headers)
+            except Exception as request_error:
+                log(
+                    '{red}could not send request to {reset}{yellow}{}:{}/{}:{reset} {white}{}{reset}',
+                    [host, port, http_path, request_error], 'error'
+                )
+                break
+            response = read_and_decode_http_response(
+                http_connection,
+                host,
+                port,
+                http_path,
+                '',
+                'fetch notification(s) from'
             )
-            break
-        response = read_and_decode_http_response(
-            http_connection,
-            host,
-            port,
-            http_path,
-            '',
-            'fetch notification(s) from'
-        )
         if type(response) is dict:
             messages = response['messages']
             message_count = len(messages)
@@ -515,20 +1188,11 @@ def fetch_link_list(
         message = notification['message'].strip()
         if not message:
             continue
-        parts = message.split(' ')
-        part_count = len(parts)
-        if part_count == 1:
-            link, path = message, prefix_path
-        elif part_count == 2:
-            link, path = parts
-            while path and path[0] == '/':
-                path = path[1:]
-            path = path_join(prefix_path, path)
-        else:
-            log('{red}detected message with unknown parts: {!r}{reset}', [message])
+        message_links = parse_link_message(message, prefix_path)
+        if message_links is None:
+            log('{red}detected message with unknown parts: {!r}{reset}', [message], 'error')
             continue
-        for templated_link in link_number_template(link):
-            links.append((templated_link, path))
+        links.extend(message_links)
     if notification_list:
         last_message_id = notification_list[-1]['id']
     return links, last_message_id
@@ -546,6 +1210,8 @@ if __name__ == '__main__':
                     '<DOWNLOAD_LINK>\n'
                     'or \n'
                     '<DOWNLOAD_LINK> <OUTPUT_DIRECTORY>\n'
+                    'or \n'
+                    '<DOWNLOAD_LINK> [<OUTPUT_DIRECTORY>] [<ALGORITHM>=<HEX_DIGEST>] [<MIRROR_LINK> ...]\n'
                     'A DOWNLOAD_LINK is a valid http/https download link.\n'
                     'If the links are similar but with a range of differnt numbers, \n'
                     'You can use a template in form of: \n'
@@ -553,9 +1219,25 @@ if __name__ == '__main__':
                     'For example: \n'
                     'http://domain.tld/foo/bar/baz/filename-[[001-117]].mkv \n'
                     'Also the OUTPUT_DIRECTORY is joined with --out-dir.\n'
+                    'If a checksum (for example sha256=...) is given, the downloaded file is verified while it is '
+                    'moved to --out-dir and re-downloaded on mismatch.\n'
+                    'Moved files can be extracted (--extract) or passed to a command (--post-command) in a pool of '
+                    '--post-process-workers processes while next links are being downloaded.\n'
                     'Before/After download and moving each downloaded file to --out-dir, it pushes the download result '
                     'to Gotify.\n'
-                    'Export "PFDNLD_SYSLOG=1" to forward all logs to syslog.\n',
+                    'Alternative links of the same file can be appended to the message, they are tried in order '
+                    'when a download fails.\n'
+                    'Failed downloads are retried up to --max-attempts times with exponential backoff, after '
+                    'new links.\n'
+                    'Use --trace-file to record timed spans of each stage of each download as Chrome trace-event '
+                    'JSON (open it in chrome://tracing or https://ui.perfetto.dev).\n'
+                    'Use --profile-file and send SIGUSR1 to start profiling, send it again to stop and write the '
+                    'cProfile stats.\n'
+                    'Export "PFDNLD_SYSLOG=1" to forward all logs to syslog.\n'
+                    'Export "PFDNLD_LOG_LEVEL=<debug|info|warning|error>" to filter logs (default: info).\n'
+                    'Export "PFDNLD_LOG_FORMAT=json" to write logs as JSON lines.\n'
+                    'Export "PFDNLD_LOG_RATE_LIMIT_BURST=<COUNT>" and "PFDNLD_LOG_RATE_LIMIT_PERIOD=<SECONDS>" to '
+                    'limit repeated warnings/errors (default: 5 per 60 seconds).\n',
         formatter_class=RawTextHelpFormatter
     )
     parser.add_argument(
@@ -665,37 +1347,127 @@ if __name__ == '__main__':
         dest='markdown',
         help='gotify render message to markdown'
     )
+    parser.add_argument(
+        '--checksum-sidecar',
+        default=None,
+        choices=CHECKSUM_ALGORITHMS,
+        dest='checksum_sidecar',
+        help='Fetch <LINK>.<CHECKSUM_SIDECAR> (for example <LINK>.sha256) to verify links without a checksum'
+    )
+    parser.add_argument(
+        '--checksum-retries',
+        default=1,
+        type=int,
+        dest='checksum_retries',
+        help='Re-download a file at most <CHECKSUM_RETRIES> time(s) if its checksum does not match'
+    )
+    parser.add_argument(
+        '--extract',
+        action='store_true',
+        default=False,
+        dest='extract',
+        help='Extract downloaded zip/tar archives in their output directory'
+    )
+    parser.add_argument(
+        '--delete-after-extract',
+        action='store_true',
+        default=False,
+        dest='delete_after_extract',
+        help='Delete archives after extracting them'
+    )
+    parser.add_argument(
+        '--post-command',
+        default=None,
+        dest='post_command',
+        help='A command to run for each downloaded file. It will replace {file} and {directory} by actual file and '
+             'its directory address, both already quoted for the shell (do not quote them again). Archives that are '
+             'extracted by --extract are skipped'
+    )
+    parser.add_argument(
+        '--post-command-pattern',
+        default='*',
+        dest='post_command_pattern',
+        help='Only run --post-command for filenames matching this shell pattern (for example \'*.part1.rar\')'
+    )
+    parser.add_argument(
+        '--post-process-workers',
+        default=2,
+        type=int,
+        dest='post_process_workers',
+        help='Number of processes that extract archives and run --post-command'
+    )
+    parser.add_argument(
+        '--trace-file',
+        default=None,
+        dest='trace_file',
+        help='Write timed spans of each download stage to this file in Chrome trace-event JSON format'
+    )
+    parser.add_argument(
+        '--profile-file',
+        default=None,
+        dest='profile_file',
+        help='Toggle cProfile on SIGUSR1 and write its stats to this file'
+    )
+    parser.add_argument(
+        '--max-attempts',
+        default=5,
+        type=int,
+        dest='max_attempts',
+        help='Try each link at most <MAX_ATTEMPTS> time(s) including its mirrors, 1 disables retrying'
+    )
+    parser.add_argument(
+        '--retry-delay',
+        default=30,
+        type=float,
+        dest='retry_delay',
+        help='Initial delay in seconds before retrying a failed link, it doubles after each round of mirrors'
+    )
+    parser.add_argument(
+        '--retry-max-delay',
+        default=3600,
+        type=float,
+        dest='retry_max_delay',
+        help='Maximum delay in seconds before retrying a failed link'
+    )
     args = parser.parse_args()
 
     if args.command == DEFAULT_COMMAND:
-        print('-' * 80)
+        log_separator()
         log('check for {white}aria2c{white} command ({white}aria2c --version{reset})')
+        flush_log()
         if run_command('aria2c --version') is not 0:
             log(
                 '{red}could not found aria2c command in the system. \n'
                 'Install it and try again. \n'
-                'For more info see: {reset}{white}https://aria2.github.io/manual/en/html/aria2c.html{reset}'
+                'For more info see: {reset}{white}https://aria2.github.io/manual/en/html/aria2c.html{reset}',
+                level='error'
             )
             exit(1)
         log('{white}aria2c{reset} command is working')
-        print('-' * 80)
-    for path, name in [
-        (args.tmp_dir, 'tmp-dir'),
-        (args.out_dir, 'out-dir')
-    ]:
+        log_separator()
+    paths = [(args.tmp_dir, 'tmp-dir'), (args.out_dir, 'out-dir')]
+    args.trace_file is not None and paths.append((args.trace_file, 'trace-file'))
+    args.profile_file is not None and paths.append((args.profile_file, 'profile-file'))
+    for path, name in paths:
         if not is_absolute_path(path):
-            log('{red}--{} ({reset}{white}{!r}{reset}{red}) MUST be absolute path address{reset}', [name, path])
+            log(
+                '{red}--{} ({reset}{white}{!r}{reset}{red}) MUST be absolute path address{reset}',
+                [name, path], 'error'
+            )
             exit(1)
     try:
         makedirs(args.tmp_dir)
     except FileExistsError:
         pass
     except Exception as make_tmp_dir_error:
-        log('{red}could not create temporary directory {!r}: {}{reset}', [args.tmp_dir, make_tmp_dir_error])
+        log('{red}could not create temporary directory {!r}: {}{reset}', [args.tmp_dir, make_tmp_dir_error], 'error')
     try:
         chdir(args.tmp_dir)
     except Exception as chdir_error:
-        log('{red}could not change working directory to temporary directory {!r}: {}', [args.tmp_dir, chdir_error])
+        log(
+            '{red}could not change working directory to temporary directory {!r}: {}',
+            [args.tmp_dir, chdir_error], 'error'
+        )
         exit(1)
 
 
@@ -714,8 +1486,29 @@ if __name__ == '__main__':
         check_period = cmd_args.check_period
         command = cmd_args.command
         output_dir = cmd_args.out_dir
+        checksum_sidecar = cmd_args.checksum_sidecar
+        checksum_retries = cmd_args.checksum_retries
+        post_process = None
+        if post_process_pool is not None:
+            post_process = make_post_processor(
+                post_process_pool,
+                cmd_args.extract,
+                cmd_args.delete_after_extract,
+                cmd_args.post_command,
+                cmd_args.post_command_pattern
+            )
+        retry_queue = []
+        schedule_retry = None
+        if cmd_args.max_attempts > 1:
+            schedule_retry = make_retry_scheduler(
+                retry_queue,
+                cmd_args.max_attempts,
+                cmd_args.retry_delay,
+                cmd_args.retry_max_delay
+            )
         last_message_id = 0
         while True:
+            fetch_span = begin_trace_span('fetch_link_list')
             links, last_message_id = fetch_link_list(
                 host,
                 client_token,
@@ -727,6 +1520,8 @@ if __name__ == '__main__':
                 timeout=http_connection_timeout,
                 limit=fetch_pagination_limit
             )
+            end_trace_span(fetch_span)
+            links.extend(pop_due_retries(retry_queue))
             if links:
                 download_links_via_command(
                     command,
@@ -739,12 +1534,38 @@ if __name__ == '__main__':
                     tls,
                     markdown,
                     port,
-                    http_connection_timeout
+                    http_connection_timeout,
+                    checksum_sidecar,
+                    checksum_retries,
+                    post_process,
+                    schedule_retry
                 )
-            print(last_message_id)
+            log('last message id is {white}{}{reset}', [last_message_id], 'debug')
             sleep(check_period)
+    if args.trace_file is not None and not enable_tracing(args.trace_file):
+        exit(1)
+    if args.profile_file is not None:
+        signal.signal(signal.SIGUSR1, lambda signal_number, frame: toggle_profiler(args.profile_file))
+    post_process_pool = None
+    if args.extract or args.post_command is not None:
+        # forkserver workers don't inherit the state of the logging thread (locks held while forking).
+        post_process_pool = ProcessPoolExecutor(
+            max_workers=max(args.post_process_workers, 1),
+            mp_context=get_multiprocessing_context('forkserver'),
+            initializer=init_post_process_worker
+        )
     try:
         main(args)
     except KeyboardInterrupt:
-        print()
+        log_separator('')
+    finally:
+        if post_process_pool is not None:
+            log('waiting for queued post-processing jobs to finish')
+            try:
+                post_process_pool.shutdown()
+            except KeyboardInterrupt:
+                log('{red}stopped waiting for post-processing jobs, cancelling queued ones{reset}', level='error')
+                post_process_pool.shutdown(wait=False, cancel_futures=True)
+        close_trace()
+        profiler is not None and toggle_profiler(args.profile_file)
     exit(0)